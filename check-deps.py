@@ -3,111 +3,109 @@
 from __future__ import annotations
 
 import sys
-import io
 import configparser
 import asyncio
 import re
+import os
+import shlex
+import signal
 
 # ~\~ begin <<lit/index.md|imports>>[0]
 from dataclasses import dataclass, field
-from typing import Optional, List, Mapping, Tuple, Callable, TypeVar
+from typing import Optional, List, Dict, Mapping, Tuple, Callable, Any, TextIO, Iterator, Coroutine
+from functools import total_ordering
 # ~\~ end
 # ~\~ begin <<lit/index.md|imports>>[1]
 from enum import Enum
 # ~\~ end
 # ~\~ begin <<lit/index.md|imports>>[2]
-from contextlib import contextmanager, redirect_stdout
-import textwrap
-# ~\~ end
-# ~\~ begin <<lit/index.md|async-cache>>[0]
-def async_cache(f):
-    async def g(self, *args, **kwargs):
-        async with self._lock:
-            if self._done:
-                return self._result
-            self._result = await f(self, *args, **kwargs)
-            self._done = True
-            return self._result
-    return g
+import operator
+# ~\~ end
+# ~\~ begin <<lit/index.md|imports>>[3]
+try:
+    import tomllib
+except ImportError:
+    tomllib = None  # type: ignore
+# ~\~ end
+# ~\~ begin <<lit/index.md|imports>>[4]
+from contextlib import contextmanager
 # ~\~ end
 # ~\~ begin <<lit/index.md|types>>[0]
+_SLOTS: Dict[str, Any] = {"slots": True} if sys.version_info >= (3, 10) else {}
+# ~\~ end
+# ~\~ begin <<lit/index.md|types>>[1]
 class ConfigError(Exception):
     pass
 
 class ParserError(Exception):
     pass
 # ~\~ end
-# ~\~ begin <<lit/index.md|types>>[1]
-@dataclass
+# ~\~ begin <<lit/index.md|types>>[2]
+@total_ordering
+@dataclass(frozen=True, **_SLOTS)
 class Version:
     number: Tuple[int, ...]
     extra: Optional[str]
 
     # ~\~ begin <<lit/index.md|version-methods>>[0]
-    def _less_than(self, other, when_equal):
-        for n, m in zip(self.number, other.number):
-            if n < m:
-                return True
-            elif n > m:
-                return False
-        return when_equal
-    # ~\~ end
-    # ~\~ begin <<lit/index.md|version-methods>>[1]
-    def __lt__(self, other):
-        return self._less_than(other, when_equal=False)
-
-    def __gt__(self, other):
-        return other._less_than(self, when_equal=False)
-
-    def __le__(self, other):
-        return self._less_than(other, when_equal=True)
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.number == other.number
 
-    def __ge__(self, other):
-        return other._less_than(self, when_equal=True)
-    # ~\~ end
-    # ~\~ begin <<lit/index.md|version-methods>>[2]
-    def __eq__(self, other):
-        for n, m in zip(self.number, other.number):
-            if n != m:
-                return False
-            return True
+    def __lt__(self, other: Version) -> bool:
+        return self.number < other.number
 
-    def __ne__(self, other):
-        return not self == other
+    def __hash__(self) -> int:
+        return hash(self.number)
     # ~\~ end
-    # ~\~ begin <<lit/index.md|version-methods>>[3]
-    def __str__(self):
+    # ~\~ begin <<lit/index.md|version-methods>>[1]
+    def __str__(self) -> str:
         return ".".join(map(str, self.number)) + (self.extra or "")
     # ~\~ end
 # ~\~ end
-# ~\~ begin <<lit/index.md|types>>[2]
+# ~\~ begin <<lit/index.md|types>>[3]
 class Relation(Enum):
-    GE = 1
-    LE = 2
-    LT = 3
-    GT = 4
-    EQ = 5
-    NE = 6
+    GE = ">="
+    LE = "<="
+    LT = "<"
+    GT = ">"
+    EQ = "=="
+    NE = "!="
 
-    def __str__(self):
-        return {"GE": ">=", "LE": "<=", "LT": "<",
-                "GT": ">", "EQ": "==", "NE": "!="}[self.name]
+    def __str__(self) -> str:
+        return self.value
 # ~\~ end
-# ~\~ begin <<lit/index.md|types>>[3]
-@dataclass
+# ~\~ begin <<lit/index.md|types>>[4]
+_REL_OPS = {
+    Relation.GE: operator.ge,
+    Relation.LE: operator.le,
+    Relation.LT: operator.lt,
+    Relation.GT: operator.gt,
+    Relation.EQ: operator.eq,
+    Relation.NE: operator.ne}
+# ~\~ end
+# ~\~ begin <<lit/index.md|types>>[5]
+@dataclass(frozen=True, **_SLOTS)
 class VersionConstraint:
     version: Version
     relation: Relation
+    _op: Callable[[Tuple[int, ...], Tuple[int, ...]], bool] = \
+        field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_op", _REL_OPS[self.relation])
 
     def __call__(self, other: Version) -> bool:
-        method = f"__{self.relation.name}__".lower()
-        return getattr(other, method)(self.version)
+        n = len(self.version.number)
+        number = (other.number + (0,) * n)[:n]
+        return self._op(number, self.version.number)
 
-    def __str__(self):
+    def __str__(self) -> str:
         return f"{self.relation}{self.version}"
 # ~\~ end
-# ~\~ begin <<lit/index.md|types>>[4]
-@dataclass
+# ~\~ begin <<lit/index.md|types>>[6]
+@dataclass(**_SLOTS)
 class VersionTest:
     # ~\~ begin <<lit/index.md|version-test-fields>>[0]
     name: str
@@ -115,7 +113,7 @@ class VersionTest:
     get_version: str
     # ~\~ end
     # ~\~ begin <<lit/index.md|version-test-fields>>[1]
-    pattern: Optional[str] = None
+    pattern: Optional[re.Pattern[bytes]] = None
     # ~\~ end
     # ~\~ begin <<lit/index.md|version-test-fields>>[2]
     suggestion_text: Optional[str] = None
@@ -128,97 +126,81 @@ class VersionTest:
     template: Optional[str] = None
     # ~\~ end
     # ~\~ begin <<lit/index.md|version-test-run>>[0]
-    _lock: asyncio.Lock = field(default_factory=asyncio.Lock)
-    _done: bool = False
+    _prefix: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        col1 = f"{self.name} {self.require}"
+        self._prefix = f"{col1:25}: "
 
-    @async_cache
-    async def run(self, recurse):
+    async def run(self, results: Mapping[str, Result]) -> Result:
         for dep in self.depends:
-            if not await recurse(dep):
+            if not results[dep].success:
                 return Result(self, False,
                               failure_text=f"Failed dependency: {dep}")
 
-        col1 = f"{self.name} {self.require}"
-        proc = await asyncio.create_subprocess_shell(
-            self.get_version,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE)
-        (stdout, stderr) = await proc.communicate()
-        if proc.returncode != 0:
-            print(f"{col1:25}: not found")
+        returncode, truncated, stdout, stderr = \
+            await run_command_cached(self.get_version)
+        if returncode != 0 and not truncated:
+            print(self._prefix + "not found")
             return Result(
                 self,
                 success=False,
                 failure_text=f"{stderr.decode().strip()}")
         try:
             if self.pattern is not None:
-                m = re.match(self.pattern, stdout.decode())
-                out, _ = parse_version(m.group(1).strip())
+                m = self.pattern.match(stdout)
+                if m is None:
+                    raise ParserError(
+                        "Output does not match pattern: "
+                        + self.pattern.pattern.decode())
+                out = parse_version_bytes(m.group(1))
             else:
-                out, _ = parse_version(stdout.decode().strip())
-        except ConfigError as e:
+                out = parse_version_bytes(stdout)
+        except ParserError as e:
+            print(self._prefix + "no version")
             return Result(self, False, failure_text=str(e))
 
         if self.require(out):
-            print(f"{col1:25}: {str(out):10} Ok")
+            print(self._prefix + f"{str(out):10} Ok")
             return Result(self, True)
         else:
-            print(f"{col1:25}: {str(out):10} Fail")
+            print(self._prefix + f"{str(out):10} Fail")
             return Result(self, False, failure_text="Too old.",
                           found_version=out)
     # ~\~ end
 # ~\~ end
-# ~\~ begin <<lit/index.md|types>>[5]
-@dataclass
+# ~\~ begin <<lit/index.md|types>>[7]
+@dataclass(frozen=True, **_SLOTS)
 class Result:
     test: VersionTest
     success: bool
     failure_text: Optional[str] = None
     found_version: Optional[Version] = None
 # ~\~ end
-# ~\~ begin <<lit/index.md|types>>[6]
-T = TypeVar("T")
-# ~\~ end
 # ~\~ begin <<lit/index.md|parsers>>[0]
-def split_at(split_chars: str, x: str) -> Tuple[str, str]:
-    a = x.split(split_chars, maxsplit=1)
-    if len(a) == 2:
-        return a[0], a[1]
-    else:
-        return a[0], ""
+_VER_RE = re.compile(r"\s*(\d+(?:\.\d+)*)(.*)", re.DOTALL)
 # ~\~ end
 # ~\~ begin <<lit/index.md|parsers>>[1]
-def parse_split_f(split_chars: str, f: Callable[[str], T], x: str) \
-        -> Tuple[T, str]:
-    item, x = split_at(split_chars, x)
-    val = f(item)
-    return val, x
+def parse_version(x: str) -> Tuple[Version, str]:
+    m = _VER_RE.match(x)
+    if not m:
+        raise ParserError(f"A version needs a numeric component, got: {x}")
+    number = tuple(map(int, m.group(1).split(".")))
+    extra = m.group(2) or None
+    return Version(number, extra), ""
 # ~\~ end
 # ~\~ begin <<lit/index.md|parsers>>[2]
-def parse_version(x: str) -> Tuple[Version, str]:
-    _x = x
-    number = []
-    extra = None
+_VER_BYTES_RE = re.compile(rb"\s*(\d+(?:\.\d+)*)(\S*)")
 
-    while True:
-        try:
-            n, _x = parse_split_f(".", int, _x)
-            number.append(n)
-        except ValueError:
-            if len(x) > 0:
-                m = re.match("([0-9]*)(.*)", _x)
-                if lastn := m and m.group(1):
-                    number.append(int(lastn))
-                if suff := m and m.group(2):
-                    extra = suff or None
-                else:
-                    extra = _x
-            break
-
-    if not number:
-        raise ParserError(f"A version needs a numeric component, got: {x}")
 
-    return Version(tuple(number), extra), _x
+def parse_version_bytes(x: bytes) -> Version:
+    m = _VER_BYTES_RE.match(x)
+    if not m:
+        got = x.decode(errors="replace").strip()
+        raise ParserError(f"A version needs a numeric component, got: {got}")
+    number = tuple(map(int, m.group(1).split(b".")))
+    extra = m.group(2).decode(errors="replace") or None
+    return Version(number, extra)
 # ~\~ end
 # ~\~ begin <<lit/index.md|parsers>>[3]
 def parse_relation(x: str) -> Tuple[Relation, str]:
@@ -241,72 +223,319 @@ def parse_version_constraint(x: str) -> Tuple[VersionConstraint, str]:
     return VersionConstraint(version, relation), x
 # ~\~ end
 # ~\~ begin <<lit/index.md|helper-functions>>[0]
-def read_config(name: str, config: Mapping[str, str], templates):
+CommandResult = Tuple[Optional[int], bool, bytes, bytes]
+_OUTPUT_LIMIT = 4096
+_GRACE = 0.5
+_TIMEOUT = 10.0
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[1]
+async def read_limited(stream: asyncio.StreamReader, buf: bytearray) -> bool:
+    while len(buf) < _OUTPUT_LIMIT:
+        chunk = await stream.read(_OUTPUT_LIMIT - len(buf))
+        if not chunk:
+            return True
+        buf += chunk
+    return stream.at_eof()
+
+
+async def drain(stream: asyncio.StreamReader) -> None:
+    while await stream.read(_OUTPUT_LIMIT):
+        pass
+
+
+async def read_capped(stream: asyncio.StreamReader, buf: bytearray) -> None:
+    if not await read_limited(stream, buf):
+        await drain(stream)
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[2]
+def kill(proc: asyncio.subprocess.Process) -> bool:
+    if proc.returncode is not None:
+        return False
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        return False
+    return True
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[3]
+async def communicate_limited(
+        proc: asyncio.subprocess.Process) -> CommandResult:
+    assert proc.stdout is not None and proc.stderr is not None
+    stdout, stderr = bytearray(), bytearray()
+    err_task = asyncio.ensure_future(read_capped(proc.stderr, stderr))
+    out_task: Optional[asyncio.Future[None]] = None
+    try:
+        if await read_limited(proc.stdout, stdout):
+            await err_task
+            await proc.wait()
+        else:
+            out_task = asyncio.ensure_future(drain(proc.stdout))
+            try:
+                await asyncio.wait_for(proc.wait(), _GRACE)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        killed = kill(proc)
+        if out_task is None:
+            out_task = asyncio.ensure_future(drain(proc.stdout))
+        await asyncio.gather(out_task, err_task, return_exceptions=True)
+
+    returncode = await proc.wait()
+    if killed:
+        return None, True, bytes(stdout), bytes(stderr)
+    return returncode, False, bytes(stdout), bytes(stderr)
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[4]
+_SHELL_CHARS = "|&;<>()$`~*?["
+_SEM: Optional[asyncio.Semaphore] = None
+
+
+def split_command(cmd: str) -> Optional[List[str]]:
+    if any(c in cmd for c in _SHELL_CHARS):
+        return None
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not argv or "=" in argv[0]:
+        return None
+    return argv
+
+
+async def run_command(cmd: str) -> CommandResult:
+    assert _SEM is not None, "the semaphore is created in `main`"
+    async with _SEM:
+        argv = split_command(cmd)
+        if argv is None:
+            proc = await asyncio.create_subprocess_shell(
+                cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True)
+        else:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True)
+            except OSError as e:
+                return 127, False, b"", str(e).encode()
+        try:
+            return await asyncio.wait_for(
+                communicate_limited(proc), _TIMEOUT)
+        except asyncio.TimeoutError:
+            await proc.wait()
+            return (None, False, b"",
+                    f"timed out after {_TIMEOUT}s".encode())
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[5]
+_CMD_CACHE: Dict[str, asyncio.Task[CommandResult]] = {}
+
+
+async def run_command_cached(cmd: str) -> CommandResult:
+    if cmd not in _CMD_CACHE:
+        _CMD_CACHE[cmd] = asyncio.create_task(run_command(cmd))
+    return await _CMD_CACHE[cmd]
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[6]
+_STR_FIELDS = ("require", "get_version", "pattern",
+               "suggestion_text", "suggestion", "template")
+
+
+def check_types(name: str, config: Mapping[str, Any]) -> None:
+    for key in _STR_FIELDS:
+        if key in config and not isinstance(config[key], str):
+            raise ConfigError(f"{name}: `{key}` should be a string")
+    deps = config.get("depends", "")
+    if not isinstance(deps, str) and not (
+            isinstance(deps, list) and all(isinstance(d, str) for d in deps)):
+        raise ConfigError(
+            f"{name}: `depends` should be a string or a list of strings")
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[7]
+def load_config() -> Tuple[Mapping[str, Mapping[str, Any]],
+                           Mapping[str, Mapping[str, Any]]]:
+    if os.path.exists("dependencies.toml"):
+        if tomllib is None:
+            raise ConfigError("reading dependencies.toml needs Python 3.11")
+        try:
+            with open("dependencies.toml", "rb") as f:
+                cfg = tomllib.load(f)
+        except tomllib.TOMLDecodeError as e:
+            raise ConfigError(f"dependencies.toml: {e}")
+        templates = cfg.pop("template", {})
+        if not isinstance(templates, dict):
+            raise ConfigError("template: expected a table")
+        for name, section in [*templates.items(), *cfg.items()]:
+            if not isinstance(section, dict):
+                raise ConfigError(f"{name}: expected a table")
+        return templates, cfg
+
+    config = configparser.ConfigParser()
+    config.read("dependencies.ini")
+    templates = {
+        name[9:]: config[name]
+        for name in config if name.startswith("template:")
+    }
+    sections = {
+        name: config[name]
+        for name in config if ":" not in name and name != "DEFAULT"
+    }
+    return templates, sections
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[8]
+Template = Dict[str, Tuple[Any, bool]]
+
+
+def prepare_template(template: Mapping[str, Any]) -> Template:
+    return {
+        k: (v, isinstance(v, str) and ("{" in v or "}" in v))
+        for k, v in template.items()
+    }
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[9]
+def read_config(name: str, config: Mapping[str, Any],
+                templates: Mapping[str, Template]) -> VersionTest:
+    _config: Dict[str, Any]
+    check_types(name, config)
     if "template" in config:
+        if config["template"] not in templates:
+            raise ConfigError(f"{name}: unknown template {config['template']}")
         _config = {}
-        for k, v in templates[config["template"]].items():
-            if isinstance(v, str):
-                _config[k] = v.format(name=name)
-            else:
-                _config[k] = v
+        for k, (v, needs_format) in templates[config["template"]].items():
+            _config[k] = v.format(name=name) if needs_format else v
         _config.update(config)
+        check_types(name, _config)
     else:
         _config = dict(config)
 
-    _deps = map(str.strip, _config.get("depends", "").split(","))
-    deps = list(filter(lambda x: x != "", _deps))
+    _deps = _config.get("depends", "")
+    if isinstance(_deps, str):
+        _deps = _deps.split(",")
+    deps = list(filter(lambda x: x != "", map(str.strip, _deps)))
 
     assert "require" in _config, "Every item needs a `require` field"
     assert "get_version" in _config, "Every item needs a `get_version` field"
 
     require, _ = parse_version_constraint(_config["require"])
 
+    pattern = None
+    if "pattern" in _config:
+        try:
+            pattern = re.compile(_config["pattern"].encode())
+        except re.error as e:
+            raise ConfigError(f"{name}: invalid pattern: {e}")
+
     return VersionTest(
         name=name,
         require=require,
         get_version=_config["get_version"],
         # platform=_config.get("platform", None),
-        pattern=_config.get("pattern", None),
+        pattern=pattern,
         suggestion_text=_config.get("suggestion_text", None),
         suggestion=_config.get("suggestion", None),
         depends=deps,
         template=_config.get("template", None))
 # ~\~ end
-# ~\~ begin <<lit/index.md|helper-functions>>[1]
+# ~\~ begin <<lit/index.md|helper-functions>>[10]
+class PrefixedWriter:
+    def __init__(self, prefix: str, out: TextIO) -> None:
+        self.prefix = prefix
+        self.out = out
+        self.at_line_start = True
+
+    def write(self, s: str) -> int:
+        parts = []
+        for line in s.splitlines(keepends=True):
+            if self.at_line_start:
+                parts.append(self.prefix)
+            parts.append(line)
+            self.at_line_start = line.endswith("\n")
+        self.out.write("".join(parts))
+        return len(s)
+
+    def flush(self) -> None:
+        self.out.flush()
+
+
 @contextmanager
-def indent(prefix: str):
-    f = io.StringIO()
-    with redirect_stdout(f):
+def indent(prefix: str) -> Iterator[None]:
+    old = sys.stdout
+    sys.stdout = PrefixedWriter(prefix, old)
+    try:
         yield
-    output = f.getvalue()
-    print(textwrap.indent(output, prefix), end="")
+    finally:
+        sys.stdout = old
 # ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[11]
+def topological_batches(tests: Mapping[str, VersionTest]) -> List[List[str]]:
+    remaining = {}
+    for name, t in tests.items():
+        for dep in t.depends:
+            if dep not in tests:
+                raise ConfigError(f"{name}: unknown dependency {dep}")
+        remaining[name] = set(t.depends)
 
-async def main():
-    # ~\~ begin <<lit/index.md|main>>[0]
-    config = configparser.ConfigParser()
-    config.read("dependencies.ini")
+    batches = []
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ConfigError(
+                "dependency cycle between " + ", ".join(remaining))
+        batches.append(ready)
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return batches
+# ~\~ end
+# ~\~ begin <<lit/index.md|helper-functions>>[12]
+async def run_batch(
+        batch: List[Coroutine[Any, Any, Result]]) -> List[Result]:
+    if sys.version_info >= (3, 11):
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(c) for c in batch]
+        return [t.result() for t in tasks]
+    return list(await asyncio.gather(*batch))
+# ~\~ end
 
-    templates = {
-        name[9:]: config[name]
-        for name in config if name.startswith("template:")
-    }
+async def main() -> None:
+    # ~\~ begin <<lit/index.md|main>>[0]
+    global _SEM
+    _SEM = asyncio.Semaphore(min(32, os.cpu_count() or 4))
 
     try:
+        raw_templates, sections = load_config()
+        templates = {
+            name: prepare_template(t) for name, t in raw_templates.items()
+        }
         tests = {
-            name: read_config(name, config[name], templates)
-            for name in config if ":" not in name and name != "DEFAULT"
+            name: read_config(name, section, templates)
+            for name, section in sections.items()
         }
-    except (AssertionError, ConfigError) as e:
+    except (AssertionError, ConfigError, ParserError) as e:
         print("Configuration error:", e)
         sys.exit(1)
+    # ~\~ end
+    # ~\~ begin <<lit/index.md|main>>[1]
+    try:
+        batches = topological_batches(tests)
+    except ConfigError as e:
+        print("Configuration error:", e)
+        sys.exit(1)
+    # ~\~ end
+    # ~\~ begin <<lit/index.md|main>>[2]
+    results: Dict[str, Result] = {}
+    for batch in batches:
+        batch_results = await run_batch(
+            [tests[name].run(results) for name in batch])
+        results.update(zip(batch, batch_results))
 
-    async def test_version(name: str):
-        assert name in tests, f"unknown dependency {name}"
-        x = await tests[name].run(test_version)
-        return x
-
-    result = await asyncio.gather(*(test_version(k) for k in tests))
+    result = [results[name] for name in tests]
     if all(r.success for r in result):
         print("Success")
         sys.exit(0)
@@ -321,5 +550,6 @@ async def main():
         sys.exit(1)
     # ~\~ end
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
 # ~\~ end